@@ -12,162 +12,509 @@
 # ***** END LICENSE BLOCK *****
 
 import argparse
+import array
+import bisect
+import collections
+import concurrent.futures
+import functools
+import hashlib
+import io
+import itertools
 import json
+import mmap
+import operator
 import os
 import requests
 import sys
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# The FUNC symbols of each module, as a list with one (starts, sizes, max_ends,
+# name_offsets, name_lengths, symfile) table per symbols file, in load order.
+# The arrays of each table are sorted by start address, so we can bisect the
+# starts array. Names are only read from the symbols file on a hit.
 symbols = {}
 filemap = {}
 
 # Public symbols have a lower priority because they lack file/line information
 symbols_public = {}
 
+# Line entries per symbols file, as parallel (starts, sizes, offsets) arrays.
+# We only keep the file offset of each entry and read the line/file number
+# from the (memory mapped) symbols file once we actually hit the entry.
 line_symbols_cache = {}
 
+# Memory mapped symbols files, opened lazily on the first line entry hit.
+symfile_maps = {}
+
+# Index of the last line entry we found per symbols file, used as a starting
+# point for the next lookup in the same file.
+last_line_idx = {}
+
 SOCORRO_AUTH_TOKEN = os.getenv("SOCORRO_AUTH_TOKEN")
 
+# Number of symbol files we download in parallel
+SYMBOLS_FETCH_WORKERS = 16
+
+# Number of symbol files we read from disk ahead of parsing them. Only files
+# up to SYMBOLS_READ_AHEAD_MAX_SIZE bytes are read ahead (into memory), larger
+# files are parsed straight from disk so we never hold them in memory whole.
+SYMBOLS_READ_AHEAD = 8
+SYMBOLS_READ_AHEAD_MAX_SIZE = 16 * 1024 * 1024
+
+# Parsed symbol files are cached in a directory we own (rather than in the
+# symbols directories we are given), keyed by the absolute path of the symbols
+# file. Bump the version whenever the format of the cache files changes.
+SYMBOLS_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".phc-symbols-cache", ".cache")
+SYMBOLS_CACHE_VERSION = 4
+
+# Number of addresses we need to look up in one symbols file before it pays
+# off to import numpy (if available) and search them all in one go.
+LINE_LOOKUP_NUMPY_MIN = 4096
+
+# Line entries in symbols files are the only records starting with a (lower
+# case) hex digit, all other records start with an upper case keyword.
+LINE_ENTRY_START = frozenset(bytes([c]) for c in b"0123456789abcdef")
+
 # A mapping from filename to debug_file to save us from doing platform-specific
 # conversions to get the debug_file name.
 debugmap = {}
 
-def load_symbols(module, symfile):
-    if module not in symbols:
-        symbols[module] = []
-
-    if symfile not in line_symbols_cache:
-        line_symbols_cache[symfile] = []
+def read_symbols_file(symfile):
+    with open(symfile, 'rb') as symfile_fd:
+        return symfile_fd.read()
+
+
+def get_symbols_cache_file(symfile):
+    symfile = os.path.abspath(symfile)
+    return os.path.join(SYMBOLS_CACHE_DIR, hashlib.sha256(symfile.encode("utf-8")).hexdigest())
+
+
+def get_symbols_cache_header(symfile, symfile_stat):
+    return {
+        "version": SYMBOLS_CACHE_VERSION,
+        "symfile": os.path.abspath(symfile),
+        "mtime": symfile_stat.st_mtime_ns,
+        "size": symfile_stat.st_size,
+        "byteorder": sys.byteorder,
+    }
+
+
+def read_symbols_cache(symfile, cache_file):
+    # The cache file starts with a short JSON header line, then a JSON line with
+    # the publics and files, followed by the raw contents of the funcs and lines
+    # arrays. We deliberately don't use pickle here, so a cache file can't run
+    # any code.
+    try:
+        symfile_stat = os.stat(symfile)
+        with open(cache_file, 'rb') as cache_fd:
+            header = json.loads(cache_fd.readline())
+            for (key, value) in get_symbols_cache_header(symfile, symfile_stat).items():
+                if header[key] != value:
+                    return None
+
+            (publics, files) = json.loads(cache_fd.readline())
+            arrays = []
+            for (typecode, itemsize, length) in header["arrays"]:
+                cached_array = array.array(typecode)
+                if cached_array.itemsize != itemsize:
+                    return None
+                cached_array.fromfile(cache_fd, length)
+                arrays.append(cached_array)
+    except (OSError, EOFError, ValueError, KeyError, TypeError):
+        return None
+
+    return (tuple(arrays[:4]), publics, files, tuple(arrays[4:]))
+
+
+def write_symbols_cache(symfile, cache_file, symfile_stat, parsed):
+    (funcs, publics, files, lines) = parsed
+    arrays = funcs + lines
+
+    header = get_symbols_cache_header(symfile, symfile_stat)
+    header["arrays"] = [(a.typecode, a.itemsize, len(a)) for a in arrays]
+
+    tmp_file = cache_file + ".part"
+    try:
+        os.makedirs(SYMBOLS_CACHE_DIR, exist_ok=True)
+        with open(tmp_file, 'wb') as cache_fd:
+            cache_fd.write(json.dumps(header).encode("utf-8") + b"\n")
+            cache_fd.write(json.dumps([publics, files]).encode("utf-8") + b"\n")
+            for cached_array in arrays:
+                cached_array.tofile(cache_fd)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        # The cache is optional, don't fail if we can't write it.
+        pass
+
+
+def prune_symbols_cache():
+    # Remove the cache files of symbols files that are gone (or that were
+    # written by another version), so the cache doesn't keep growing as old
+    # symbols are deleted. We only need to read the short header line.
+    try:
+        cache_entries = list(os.scandir(SYMBOLS_CACHE_DIR))
+    except OSError:
+        return
 
-    with open(symfile, 'r') as symfile_fd:
-        for line in symfile_fd:
-            line = line.rstrip()
-            if line.startswith("MODULE "):
-                pass
-            elif line.startswith("FILE "):
-                # FILE 14574 hg:hg.mozilla.org/try:xpcom/io/nsLocalFileCommon.cpp:8ff5f360a1909a75f636e93860aa456625df25f7
-                tmp = line.split(" ", maxsplit=2)
-                if symfile not in filemap:
-                    filemap[symfile] = {}
-                # FILE definitions are *not* per module as one would expect,
-                # but actually per symbols file (so the same FILE id can appear
-                # multiple times per module, in distinct symbols files).
-                filemap[symfile][tmp[1]] = tmp[2]
-            elif line.startswith("PUBLIC "):
-                # PUBLIC (m) 7f5c0 0 gdk_x11_get_server_time
-                tmp = line.split(" ", maxsplit=3)
-
-                # Support the optional "m" indicator for folded code
-                base_idx = 0
-                if tmp[1] == 'm':
-                    base_idx = 1
-                    tmp = line.split(" ", maxsplit=4)
-
-                symbol_start = int(tmp[base_idx + 1], 16)
-
-                if module not in symbols_public:
-                    symbols_public[module] = []
-                else:
-                    # Set the end of the last symbol we parsed
-                    symbols_public[module][-1][1] = symbol_start
-
-                # Push new symbol with 0 as end, so we can fix it later
-                symbols_public[module].append([symbol_start, 0, tmp[base_idx + 3]])
-            elif line.startswith("STACK "):
-                pass
-            elif line.startswith("INFO "):
+    for cache_entry in cache_entries:
+        if cache_entry.name.endswith(".part"):
+            continue
+        try:
+            with open(cache_entry.path, 'rb') as cache_fd:
+                header = json.loads(cache_fd.readline())
+            stale = header["version"] != SYMBOLS_CACHE_VERSION or not os.path.exists(header["symfile"])
+        except OSError:
+            continue
+        except (ValueError, KeyError, TypeError):
+            stale = True
+
+        if stale:
+            try:
+                os.remove(cache_entry.path)
+            except OSError:
                 pass
-            elif line.startswith("FUNC "):
-                # FUNC (m) 8e5440 14e 0 webrtc::AudioProcessingImpl::Initialize
-                tmp = line.split(" ", maxsplit=4)
-
-                # Support the optional "m" indicator for folded code
-                base_idx = 0
-                if tmp[1] == 'm':
-                    base_idx = 1
-                    tmp = line.split(" ", maxsplit=5)
-
-                comps = [int(tmp[base_idx + 1], 16), int(tmp[base_idx + 2], 16), tmp[base_idx + 4], symfile]
-                symbols[module].append(comps)
-            else:
-                # This is a line entry:
-                # address size line filenum
-                # a51fd3 35 433 14574
-                line_symbols_cache[symfile].append(line)
 
 
-def load_symbols_recursive(symbols_dir):
-        for (path, dirs, files) in os.walk(symbols_dir):
-            for file in files:
-                fp_file = os.path.join(path, file)
+def read_symbols(symfile, cache_file):
+    # Returns either the parsed symbols from the cache, or the raw contents of
+    # the symbols file (None for large files, which we parse from disk) along
+    # with its stat result (to create the cache later). A cache_file of None
+    # means we don't use the cache.
+    if cache_file is not None:
+        parsed = read_symbols_cache(symfile, cache_file)
+        if parsed is not None:
+            return (parsed, None, None)
+
+    symfile_stat = os.stat(symfile)
+    if symfile_stat.st_size > SYMBOLS_READ_AHEAD_MAX_SIZE:
+        return (None, None, symfile_stat)
+
+    return (None, read_symbols_file(symfile), symfile_stat)
+
+
+def parse_file_or_func_record(line, line_offset, parsed):
+    (funcs, publics, files, lines) = parsed
+
+    if line.startswith(b"FUNC "):
+        # FUNC (m) 8e5440 14e 0 webrtc::AudioProcessingImpl::Initialize
+        tmp = line.split(b" ", maxsplit=4)
+
+        # Support the optional "m" indicator for folded code
+        base_idx = 0
+        if tmp[1] == b'm':
+            base_idx = 1
+            tmp = line.split(b" ", maxsplit=5)
+
+        # We only remember where the name is in the symbols file, most names
+        # are never looked at.
+        name = tmp[base_idx + 4]
+        (func_starts, func_sizes, func_name_offsets, func_name_lengths) = funcs
+        func_starts.append(int(tmp[base_idx + 1], 16))
+        func_sizes.append(int(tmp[base_idx + 2], 16))
+        func_name_offsets.append(line_offset + len(line) - len(name))
+        func_name_lengths.append(len(name.rstrip()))
+    elif line.startswith(b"FILE "):
+        line = line.rstrip().decode("utf-8", "replace")
+        # FILE 14574 hg:hg.mozilla.org/try:xpcom/io/nsLocalFileCommon.cpp:8ff5f360a1909a75f636e93860aa456625df25f7
+        tmp = line.split(" ", maxsplit=2)
+        # FILE definitions are *not* per module as one would expect,
+        # but actually per symbols file (so the same FILE id can appear
+        # multiple times per module, in distinct symbols files).
+        files[tmp[1]] = tmp[2]
+
+
+def parse_public_record(line, line_offset, parsed):
+    (funcs, publics, files, lines) = parsed
+
+    if line.startswith(b"PUBLIC "):
+        line = line.rstrip().decode("utf-8", "replace")
+        # PUBLIC (m) 7f5c0 0 gdk_x11_get_server_time
+        tmp = line.split(" ", maxsplit=3)
 
-                if fp_file.endswith(".sym"):
-                    rel_file = fp_file.replace(symbols_dir, "", 1)
-                    comps = rel_file.split(os.sep)
-                    module = os.path.splitext(comps[-1])[0]
+        # Support the optional "m" indicator for folded code
+        base_idx = 0
+        if tmp[1] == 'm':
+            base_idx = 1
+            tmp = line.split(" ", maxsplit=4)
+
+        symbol_start = int(tmp[base_idx + 1], 16)
+
+        if publics:
+            # Set the end of the last symbol we parsed
+            publics[-1][1] = symbol_start
+
+        # Push new symbol with 0 as end, so we can fix it later
+        publics.append([symbol_start, 0, tmp[base_idx + 3]])
+
+
+# Parsers for the records we use, by the first character of the record.
+# Records we don't use (MODULE, INFO, STACK, INLINE, ...) have no entry.
+RECORD_PARSERS = {
+    b"F": parse_file_or_func_record,
+    b"P": parse_public_record,
+}
+
+
+def parse_symbols(symfile_fd):
+    # Parses a symbols file into a (funcs, publics, files, lines) tuple, where
+    # funcs are parallel (starts, sizes, name_offsets, name_lengths) arrays and
+    # lines are parallel (starts, sizes, offsets) arrays.
+    parsed = (
+        (array.array('Q'), array.array('I'), array.array('Q'), array.array('I')),
+        [],
+        {},
+        (array.array('Q'), array.array('I'), array.array('Q')),
+    )
+    (line_starts, line_sizes, line_offsets) = parsed[3]
+
+    offset = 0
+    for line in symfile_fd:
+        line_offset = offset
+        offset += len(line)
+        # Dispatch on the first character before doing anything else with
+        # the line. Most lines are line entries, which we parse right here
+        # and for which we only need the first two fields (so no need to
+        # strip the line ending). Other records go to RECORD_PARSERS.
+        first = line[:1]
+        if first in LINE_ENTRY_START:
+            # This is a line entry:
+            # address size line filenum
+            # a51fd3 35 433 14574
+            tmp = line.split(b" ", maxsplit=3)
+            if len(tmp) < 4:
+                continue
+            try:
+                (start_addr, size) = (int(tmp[0], 16), int(tmp[1], 16))
+                line_sizes.append(size)
+            except (ValueError, OverflowError):
+                # Ignore any malformed entries
+                continue
+            line_starts.append(start_addr)
+            line_offsets.append(line_offset)
+        else:
+            record_parser = RECORD_PARSERS.get(first)
+            if record_parser is not None:
+                record_parser(line, line_offset, parsed)
 
-                    load_symbols(module, fp_file)
+    return parsed
 
 
-def retrieve_file_line_data_linear(symbol_entry, reladdr):
-    # We reopen the symbols file and retrieve line data on the fly
-    # because storing all of it in load_symbols is very memory intense.
-    symfile = symbol_entry[3]
-    with open(symfile, 'r') as symfile_fd:
-        for line in symfile_fd:
-            tmp = line.split(" ", maxsplit=3)
-            try:
-                start_addr = int(tmp[0], 16)
-                if start_addr <= reladdr:
-                    size = int(tmp[1], 16)
-                    if (start_addr + size) > reladdr:
-
-                        return (tmp[2], tmp[3].rstrip())
-            except ValueError:
-                # Ignore any non-line entries
-                pass
-    return (None, None)
+def add_symbols(module, symfile, parsed):
+    (funcs, publics, files, lines) = parsed
 
+    if module not in symbols:
+        symbols[module] = []
 
-def retrieve_file_line_data_binsearch(symbol_entry, reladdr):
-    symfile = symbol_entry[3]
-    lines = line_symbols_cache[symfile]
+    # Keep the FUNCs of each symbols file apart, a module can have symbols for
+    # several builds whose FUNCs overlap.
+    symbols[module].append(make_func_table(funcs, symfile))
 
-    if not lines:
-        return (None, None)
+    if publics:
+        if module not in symbols_public:
+            symbols_public[module] = []
+        else:
+            # Set the end of the last symbol we parsed
+            symbols_public[module][-1][1] = publics[0][0]
+        symbols_public[module].extend(publics)
 
-    cmin = 0
-    cmax = len(lines) - 1
-    cidx = int(len(lines) / 2)
+    if files:
+        filemap[symfile] = files
 
-    while (cmax - cmin) >= 0 and cidx <= cmax:
-        line = lines[cidx]
-        tmp = line.split(" ", maxsplit=3)
-        try:
-            start_addr = int(tmp[0], 16)
-            if start_addr <= reladdr:
-                size = int(tmp[1], 16)
-                if (start_addr + size) > reladdr:
-                    return (tmp[2], tmp[3].rstrip())
-                else:
-                    cmin = cidx + 1
-                    cidx = cmin + int((cmax - cmin) / 2)
-            else:
-                cmax = cidx - 1
-                cidx = cmin + int((cmax - cmin) / 2)
-        except ValueError:
-            # Ignore any non-line entries
-            cidx += 1
+    line_symbols_cache[symfile] = lines
 
-    return (None, None)
 
+def load_symbols(module, symfile, cache_file, symbols_read):
+    (parsed, symfile_data, symfile_stat) = symbols_read
+    if parsed is None:
+        if symfile_data is None:
+            with open(symfile, 'rb') as symfile_fd:
+                parsed = parse_symbols(symfile_fd)
+        else:
+            with io.BytesIO(symfile_data) as symfile_fd:
+                parsed = parse_symbols(symfile_fd)
+        if cache_file is not None:
+            write_symbols_cache(symfile, cache_file, symfile_stat, parsed)
+    add_symbols(module, symfile, parsed)
 
-def retrieve_file_line_data(symbol_entry, reladdr):
-    return retrieve_file_line_data_binsearch(symbol_entry, reladdr)
+
+def load_symbols_recursive(symbols_dir, use_cache=True):
+        sym_files = []
+        for (path, dirs, files) in os.walk(symbols_dir):
+            # Don't descend into our cache, in case it is in the symbols dir
+            dirs[:] = [d for d in dirs if os.path.abspath(os.path.join(path, d)) != SYMBOLS_CACHE_DIR]
+
+            for file in files:
+                fp_file = os.path.join(path, file)
+
+                if fp_file.endswith(".sym"):
+                    rel_file = fp_file.replace(symbols_dir, "", 1)
+                    comps = rel_file.split(os.sep)
+                    module = os.path.splitext(comps[-1])[0]
+
+                    cache_file = get_symbols_cache_file(fp_file) if use_cache else None
+                    sym_files.append((module, fp_file, cache_file))
+
+        # Parsing is bound by the interpreter, but we can have the next few
+        # files read (or loaded from the cache) by worker threads while we parse
+        # the current one.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=SYMBOLS_READ_AHEAD) as executor:
+            pending = collections.deque()
+            for (module, fp_file, cache_file) in sym_files:
+                pending.append((module, fp_file, cache_file, executor.submit(read_symbols, fp_file, cache_file)))
+                if len(pending) > SYMBOLS_READ_AHEAD:
+                    (next_module, next_file, next_cache_file, next_read) = pending.popleft()
+                    load_symbols(next_module, next_file, next_cache_file, next_read.result())
+
+            while pending:
+                (next_module, next_file, next_cache_file, next_read) = pending.popleft()
+                load_symbols(next_module, next_file, next_cache_file, next_read.result())
+
+        if use_cache:
+            prune_symbols_cache()
+
+
+def make_func_table(funcs, symfile):
+    # We sort the FUNCs of a symbols file stably by start address, they usually
+    # are already, so check that first. FUNCs may still nest or overlap (e.g.
+    # folded code), so we also keep the highest end address of all FUNCs up to
+    # each index, which tells resolve_symbol() when to stop looking back.
+    (starts, sizes, name_offsets, name_lengths) = funcs
+    if not all(map(operator.le, starts, itertools.islice(starts, 1, None))):
+        order = sorted(range(len(starts)), key=starts.__getitem__)
+        starts = array.array('Q', [starts[idx] for idx in order])
+        sizes = array.array('I', [sizes[idx] for idx in order])
+        name_offsets = array.array('Q', [name_offsets[idx] for idx in order])
+        name_lengths = array.array('I', [name_lengths[idx] for idx in order])
+
+    max_ends = array.array('Q', itertools.accumulate(map(operator.add, starts, sizes), max))
+    return (starts, sizes, max_ends, name_offsets, name_lengths, symfile)
+
+
+def get_symfile_map(symfile):
+    if symfile not in symfile_maps:
+        with open(symfile, 'rb') as symfile_fd:
+            symfile_maps[symfile] = mmap.mmap(symfile_fd.fileno(), 0, access=mmap.ACCESS_READ)
+    return symfile_maps[symfile]
+
+
+def read_symbol_name(module, table_idx, idx):
+    (starts, sizes, max_ends, name_offsets, name_lengths, symfile) = symbols[module][table_idx]
+    symfile_map = get_symfile_map(symfile)
+    offset = name_offsets[idx]
+    return symfile_map[offset:offset + name_lengths[idx]].decode("utf-8", "replace")
+
+
+def read_line_entry(symfile, idx):
+    symfile_map = get_symfile_map(symfile)
+
+    offset = line_symbols_cache[symfile][2][idx]
+    end = symfile_map.find(b"\n", offset)
+    if end < 0:
+        end = len(symfile_map)
+
+    # address size line filenum
+    tmp = symfile_map[offset:end].rstrip().decode("utf-8", "replace").split(" ", maxsplit=3)
+    return (tmp[2], tmp[3])
+
+
+def find_line_entry(symfile, reladdr):
+    (line_starts, line_sizes, line_offsets) = line_symbols_cache[symfile]
+
+    # Lookups in the same symbols file are usually clustered (frames within
+    # the same function), so we first check the last hit and its successor.
+    last = last_line_idx.get(symfile)
+    if last is not None:
+        for idx in (last, last + 1):
+            if idx < len(line_starts) and line_starts[idx] <= reladdr < (line_starts[idx] + line_sizes[idx]):
+                last_line_idx[symfile] = idx
+                return idx
+
+    idx = bisect.bisect_right(line_starts, reladdr) - 1
+    if idx >= 0 and (line_starts[idx] + line_sizes[idx]) > reladdr:
+        last_line_idx[symfile] = idx
+        return idx
+
+    return None
+
+
+@functools.lru_cache(maxsize=None)
+def import_numpy():
+    # numpy is optional and takes a while to import, so we only import it
+    # once we have a batch of lookups that is worth it.
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def retrieve_file_line_data_bulk(symfile, reladdrs):
+    # Looks up the file/line information for many addresses in the same
+    # symbols file at once, using a single vectorized search for large
+    # batches if we have numpy.
+    (line_starts, line_sizes, line_offsets) = line_symbols_cache[symfile]
+
+    if not line_starts:
+        return [(None, None)] * len(reladdrs)
+
+    numpy = None
+    if len(reladdrs) >= LINE_LOOKUP_NUMPY_MIN:
+        numpy = import_numpy()
+
+    if numpy is None:
+        idxs = [find_line_entry(symfile, reladdr) for reladdr in reladdrs]
+    else:
+        starts = numpy.frombuffer(line_starts, dtype=numpy.uint64)
+        sizes = numpy.frombuffer(line_sizes, dtype=numpy.uint32)
+        addrs = numpy.array(reladdrs, dtype=numpy.uint64)
+
+        found = numpy.searchsorted(starts, addrs, side='right') - 1
+        clamped = numpy.maximum(found, 0)
+        hits = (found >= 0) & (addrs < starts[clamped] + sizes[clamped])
+        idxs = [int(idx) if hit else None for (idx, hit) in zip(found, hits)]
+
+        # Keep the starting point for find_line_entry() up to date, as if we
+        # had looked up the addresses one by one.
+        hit_idxs = [idx for idx in idxs if idx is not None]
+        if hit_idxs:
+            last_line_idx[symfile] = hit_idxs[-1]
+
+    return [(None, None) if idx is None else read_line_entry(symfile, idx) for idx in idxs]
+
+
+@functools.lru_cache(maxsize=8192)
+def resolve_symbol(module, reladdr):
+    # Stack frames repeat a lot (e.g. common call sites shared by the alloc
+    # and free stacks), so we memoize the FUNC lookups per address. Returns the
+    # (table index, FUNC index) of the first symbols file that has a hit.
+    #
+    # Within a file, the last FUNC starting at or before the address may not
+    # contain it while an earlier, enclosing FUNC does. So we walk back from
+    # there for as long as an earlier FUNC still ends past the address, and
+    # take the first FUNC that contains it. For files with their FUNCs in
+    # address order (as dump_syms writes them) that is the first one in file
+    # order, like a linear scan of the file would find.
+    for (table_idx, (starts, sizes, max_ends, name_offsets, name_lengths, symfile)) in enumerate(symbols[module]):
+        hit = None
+        idx = bisect.bisect_right(starts, reladdr) - 1
+        while idx >= 0 and max_ends[idx] > reladdr:
+            if (starts[idx] + sizes[idx]) > reladdr:
+                hit = idx
+            idx -= 1
+
+        if hit is not None:
+            return (table_idx, hit)
+
+    return None
 
 
 def read_extra_file(extra_file):
     def make_stack_array(line):
-        return [int(x) for x in line.rstrip().split(sep="=")[1].split(",")]
+        return [int(x) for x in line.partition("=")[2].rstrip().split(",")]
 
     alloc_stack = None
     free_stack = None
@@ -180,7 +527,8 @@ def read_extra_file(extra_file):
             elif line.startswith("PHCFreeStack"):
                 free_stack = make_stack_array(line)
             elif line.startswith("StackTraces"):
-                obj = json.loads(line.split(sep="=")[1])
+                # Only split off the key, the JSON itself can contain '='
+                (obj, _) = json.JSONDecoder().raw_decode(line, line.index("=") + 1)
                 modules = obj["modules"]
 
     module_memory_map = {}
@@ -191,19 +539,35 @@ def read_extra_file(extra_file):
     return (alloc_stack, free_stack, module_memory_map)
 
 
-def fetch_socorro_crash(crash_id):
+def parse_json_response(response):
+    # Processed crashes can be several megabytes of JSON, so we use the much
+    # faster orjson parser if it is available.
+    if orjson is not None:
+        return orjson.loads(response.content)
+    return response.json()
+
+
+def create_session():
+    # All our requests go through one session, so connections (and their TLS
+    # handshakes) are reused. The pool is sized for our parallel downloads.
+    session = requests.Session()
+    session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=SYMBOLS_FETCH_WORKERS))
+    return session
+
+
+def fetch_socorro_crash(crash_id, session):
     headers = {'Auth-Token': SOCORRO_AUTH_TOKEN}
 
     raw_url = 'https://crash-stats.mozilla.org/api/RawCrash/?crash_id=%s&format=meta' % crash_id
     processed_url = 'https://crash-stats.mozilla.org/api/ProcessedCrash/?crash_id=%s&datatype=processed' % crash_id
 
-    response = requests.get(raw_url, headers=headers)
+    response = session.get(raw_url, headers=headers)
 
     if not response.ok:
         print("Error: Failed to fetch raw data from Socorro", file=sys.stderr)
         return (None, None, None, None, None)
 
-    raw_data = response.json()
+    raw_data = parse_json_response(response)
 
     if "PHCAllocStack" not in raw_data:
         print("Error: No PHCAllocStack in raw data, is this really a PHC crash?", file=sys.stderr)
@@ -215,13 +579,13 @@ def fetch_socorro_crash(crash_id):
     else:
         free_stack = None
 
-    response = requests.get(processed_url, headers=headers)
+    response = session.get(processed_url, headers=headers)
 
     if not response.ok:
         print("Error: Failed to fetch processed data from Socorro", file=sys.stderr)
         return (None, None, None, None, None)
 
-    processed_data = response.json()
+    processed_data = parse_json_response(response)
 
     module_memory_map = {}
     remote_symbols_files = set()
@@ -238,46 +602,57 @@ def fetch_socorro_crash(crash_id):
     return (alloc_stack, free_stack, module_memory_map, remote_symbols_files, memory_map_remote)
 
 
-def fetch_remote_symbols(url, symbols_dir):
+def fetch_remote_symbols(url, symbols_dir, session):
     url_comps = url.split("/")
     dest_dir = os.path.join(symbols_dir, url_comps[-2])
 
-    if not os.path.exists(dest_dir):
-        os.makedirs(dest_dir)
+    # Other workers might be creating the same directory concurrently
+    os.makedirs(dest_dir, exist_ok=True)
 
     dest_file = os.path.join(dest_dir, url_comps[-1])
 
-    sys.stderr.write("Fetching %s ... " % url)
-
     if os.path.exists(dest_file):
-        print(" cached!", file=sys.stderr)
+        print("Fetching %s ...  cached!" % url, file=sys.stderr)
         return
 
-    response = requests.get(url)
-    print("done!", file=sys.stderr)
+    # Stream the raw bytes to disk instead of buffering (and decoding) the
+    # whole file in memory. We write to a temporary file first so that an
+    # interrupted download doesn't end up being treated as cached later.
+    tmp_file = dest_file + ".part"
+    with session.get(url, stream=True) as response:
+        if not response.ok:
+            print("Error: Failed to fetch %s (HTTP %s)" % (url, response.status_code), file=sys.stderr)
+            return
 
-    with open(dest_file, 'w') as fd:
-        fd.write(response.text)
+        with open(tmp_file, 'wb') as fd:
+            for chunk in response.iter_content(chunk_size=65536):
+                fd.write(chunk)
+    os.replace(tmp_file, dest_file)
+
+    print("Fetching %s ... done!" % url, file=sys.stderr)
 
     return
 
 
-def find_module(addr, module_memory_map):
-    # Figure out which module this address belongs to
-    (module, reladdr) = (None, None)
-    for module_cand in module_memory_map:
-        base_addr = module_memory_map[module_cand][0]
-        end_addr = module_memory_map[module_cand][1]
+def build_module_index(module_memory_map):
+    # Sort the modules by base address once, so we can bisect for the module
+    # containing an address instead of scanning the whole memory map.
+    sorted_modules = sorted(module_memory_map.items(), key=lambda item: item[1][0])
+    return (
+        array.array('Q', [item[1][0] for item in sorted_modules]),
+        array.array('Q', [item[1][1] for item in sorted_modules]),
+        [item[0] for item in sorted_modules],
+    )
 
-        if addr >= base_addr and addr < end_addr:
-            module = module_cand
-            reladdr = addr - base_addr
-            break
 
-    if not module:
-        return (None, None)
+def find_module(addr, module_index):
+    # Figure out which module this address belongs to
+    (module_bases, module_ends, module_names) = module_index
+    idx = bisect.bisect_right(module_bases, addr) - 1
+    if idx >= 0 and addr < module_ends[idx]:
+        return (module_names[idx], addr - module_bases[idx])
 
-    return (module, reladdr)
+    return (None, None)
 
 
 def main(argv=None):
@@ -292,6 +667,7 @@ def main(argv=None):
     parser = argparse.ArgumentParser(usage='%s (EXTRA_FILE SYMBOLS_DIR | --remote CRASH_ID)' % program_name)
     parser.add_argument("--remote", dest="remote", help="Remote mode, fetch a crash from Socorro", metavar="CRASH_ID")
     parser.add_argument("--parse-local", dest="parse_local", help="Download symbol files and parse them locally", action="store_true")
+    parser.add_argument("--no-symbols-cache", dest="symbols_cache", help="Don't read or write the cache of parsed symbol files", action="store_false")
     parser.add_argument('rargs', nargs=argparse.REMAINDER)
 
     if not argv:
@@ -313,6 +689,9 @@ def main(argv=None):
     # addresses to relative debug symbol addresses.
     module_memory_map = None
 
+    # The module memory map sorted by base address, see build_module_index
+    module_index = None
+
     # Directory where we either have local symbols or store remote symbols
     symbols_dir = None
 
@@ -324,7 +703,14 @@ def main(argv=None):
             print("Error: Must specify SOCORRO_AUTH_TOKEN in environment for remote actions.", file=sys.stderr)
             return 2
 
-        (alloc_stack, free_stack, module_memory_map, remote_symbols_files, memory_map_remote) = fetch_socorro_crash(opts.remote)
+        session = create_session()
+
+        (alloc_stack, free_stack, module_memory_map, remote_symbols_files, memory_map_remote) = fetch_socorro_crash(opts.remote, session)
+
+        if module_memory_map is None:
+            return 2
+
+        module_index = build_module_index(module_memory_map)
 
         if not opts.parse_local:
             # We will query the symbol server to get the stacks symbolized.
@@ -336,7 +722,7 @@ def main(argv=None):
                 if stack is not None:
                     stacks = []
                     for addr in stack:
-                        (module, reladdr) = find_module(addr, module_memory_map)
+                        (module, reladdr) = find_module(addr, module_index)
 
                         if module is None:
                             stacks.append([0, 0])
@@ -362,7 +748,7 @@ def main(argv=None):
 
                     request["stacks"].append(stacks)
 
-            symbol_server_response = requests.post("https://symbols.mozilla.org/symbolicate/v5", json=request).json()
+            symbol_server_response = session.post("https://symbols.mozilla.org/symbolicate/v5", json=request).json()
             if "results" not in symbol_server_response:
                 print("Error in server response: %s" % symbol_server_response, file=sys.stderr)
                 return 2
@@ -374,11 +760,13 @@ def main(argv=None):
             if not os.path.exists(symbols_dir):
                 os.mkdir(symbols_dir)
 
-            for symbol_url in remote_symbols_files:
-                fetch_remote_symbols(symbol_url, symbols_dir)
+            # Download in parallel, reusing connections to the symbol server.
+            with concurrent.futures.ThreadPoolExecutor(max_workers=SYMBOLS_FETCH_WORKERS) as executor:
+                list(executor.map(lambda symbol_url: fetch_remote_symbols(symbol_url, symbols_dir, session),
+                                  remote_symbols_files))
 
             sys.stderr.write("Loading downloaded symbols...")
-            load_symbols_recursive(symbols_dir)
+            load_symbols_recursive(symbols_dir, opts.symbols_cache)
             print(" done!", file=sys.stderr)
     else:
         extra_file = opts.rargs[0]
@@ -396,41 +784,76 @@ def main(argv=None):
             symbols_dir += os.sep
 
         sys.stderr.write("Loading local symbols...")
-        load_symbols_recursive(symbols_dir)
+        load_symbols_recursive(symbols_dir, opts.symbols_cache)
         print(" done!", file=sys.stderr)
 
         (alloc_stack, free_stack, module_memory_map) = read_extra_file(extra_file)
+        module_index = build_module_index(module_memory_map)
+
+    # Alloc and free stacks usually share a good part of their frames, so
+    # remember the module lookups across both stacks.
+    @functools.lru_cache(maxsize=8192)
+    def resolve_module(addr):
+        return find_module(addr, module_index)
 
-    def print_stack(phc_stack, name, symbols, module_memory_map):
+    def print_stack(phc_stack, name, symbols):
         stack_cnt = 0
 
-        print("%s stack:" % name)
-        print("")
-        for addr in phc_stack:
-            (module, reladdr) = find_module(addr, module_memory_map)
+        def find_symbols_module(module):
+            if module in symbols:
+                return module
 
+            # On Windows, the sym file is called xul.sym, *not* xul.dll.sym
+            # unlike on Linux where it is called xul.so.sym.
+            tmp = os.path.splitext(module)[0]
+            if tmp in symbols:
+                return tmp
+
+            return None
+
+        # Resolve all frames first, so we can look up the file/line information
+        # grouped by symbols file, searching each file in one batch.
+        frames = []
+        line_lookups = {}
+        for addr in phc_stack:
+            (module, reladdr) = resolve_module(addr)
+            sym_module = None
+            sym_idx = None
+            if module:
+                sym_module = find_symbols_module(module)
+            if sym_module:
+                sym_idx = resolve_symbol(sym_module, reladdr)
+                if sym_idx is not None:
+                    line_lookups.setdefault(symbols[sym_module][sym_idx[0]][5], set()).add(reladdr)
+            frames.append((module, sym_module, reladdr, sym_idx))
+
+        line_data = {}
+        for (symfile, reladdrs) in line_lookups.items():
+            reladdrs = sorted(reladdrs)
+            for (reladdr, entry) in zip(reladdrs, retrieve_file_line_data_bulk(symfile, reladdrs)):
+                line_data[(symfile, reladdr)] = entry
+
+        # Collect the output and write it at once rather than line by line.
+        out = ["%s stack:" % name, ""]
+        for (module, sym_module, reladdr, sym_idx) in frames:
             if not module:
-                print("#%s    (frame in unknown module)" % stack_cnt)
+                out.append("#%s    (frame in unknown module)" % stack_cnt)
                 stack_cnt += 1
                 continue
 
-            if module not in symbols:
-                # On Windows, the sym file is called xul.sym, *not* xul.dll.sym
-                # unlike on Linux where it is called xul.so.sym.
-                tmp = os.path.splitext(module)[0]
-                if tmp in symbols:
-                    module = tmp
-                else:
-                    print("#%s    (missing symbols for module %s %s)" % (stack_cnt, module, hex(reladdr)))
-                    stack_cnt += 1
-                    continue
+            if not sym_module:
+                out.append("#%s    (missing symbols for module %s %s)" % (stack_cnt, module, hex(reladdr)))
+                stack_cnt += 1
+                continue
+
+            module = sym_module
 
             symbol_entry = None
-            for sym in symbols[module]:
-                if sym[0] <= reladdr and (sym[0] + sym[1]) > reladdr:
-                    print("#%s    %s" % (stack_cnt, sym[2]))
-                    symbol_entry = sym
-                    break
+            if sym_idx is not None:
+                (table_idx, idx) = sym_idx
+                (starts, sizes, max_ends, name_offsets, name_lengths, symfile) = symbols[module][table_idx]
+                symbol_entry = (starts[idx], sizes[idx], read_symbol_name(module, table_idx, idx), symfile)
+                out.append("#%s    %s" % (stack_cnt, symbol_entry[2]))
 
             if not symbol_entry:
                 # There is still a chance that we have a PUBLIC symbol without
@@ -438,26 +861,29 @@ def main(argv=None):
                 if module in symbols_public:
                     for sym in symbols_public[module]:
                         if sym[0] <= reladdr and sym[1] > reladdr:
-                            print("#%s    %s (%s +%s)" % (stack_cnt, sym[2], module, hex(reladdr)))
+                            out.append("#%s    %s (%s +%s)" % (stack_cnt, sym[2], module, hex(reladdr)))
                             symbol_entry = sym
                             break
 
                 if not symbol_entry:
-                    print("#%s    ??? (unresolved symbol in %s +%s)" % (stack_cnt, module, hex(reladdr)))
+                    out.append("#%s    ??? (unresolved symbol in %s +%s)" % (stack_cnt, module, hex(reladdr)))
             else:
-                (line, filenum) = retrieve_file_line_data_binsearch(symbol_entry, reladdr)
                 symfile = symbol_entry[3]
+                (line, filenum) = line_data[(symfile, reladdr)]
                 if filenum and symfile in filemap:
-                    print("    in file %s line %s" % (filemap[symfile][filenum], line))
+                    out.append("    in file %s line %s" % (filemap[symfile][filenum], line))
 
             stack_cnt += 1
 
+        sys.stdout.write("\n".join(out) + "\n")
+
     def print_stack_remote(stack, name):
-        print("%s stack:" % name)
-        print("")
+        out = ["%s stack:" % name, ""]
 
         for entry in stack:
-            print("#%s    %s (%s)" % (entry["frame"], entry["function"], entry["module"]))
+            out.append("#%s    %s (%s)" % (entry["frame"], entry["function"], entry["module"]))
+
+        sys.stdout.write("\n".join(out) + "\n")
 
     if symbol_server_response:
         stacks = symbol_server_response["results"][0]["stacks"]
@@ -469,9 +895,9 @@ def main(argv=None):
     else:
         if free_stack is not None:
             print("")
-            print_stack(free_stack, "Free", symbols, module_memory_map)
+            print_stack(free_stack, "Free", symbols)
         print("")
-        print_stack(alloc_stack, "Alloc", symbols, module_memory_map)
+        print_stack(alloc_stack, "Alloc", symbols)
 
 
 if __name__ == '__main__':